@@ -1,22 +1,57 @@
 import os
-import json
 import re
+import contextlib
+import orjson
 import pandas as pd
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from uploader import HerokuPostgreSQLUploader
 
+# Directory containing the user JSON files, and the output read by the workflow
+MIXED_DIR = os.path.join(os.path.dirname(__file__), "mixed")
+OUTPUT_FILE = 'processed_data.json'
+
+# Below this many files a process pool costs more to start than it saves
+PARALLEL_FILE_THRESHOLD = 64
+
+# Task-level columns of a user with no tasks; also fixes where they sit in each record
+_EMPTY_TASK_FIELDS = {
+    'program_id': '',
+    'brand': '',
+    'task_id': '',
+    'platform': '',
+    'post_url': '',
+    'url_valid': False,
+    'likes': 0,
+    'comments': 0,
+    'shares': 0,
+    'reach': 0,
+    'total_sales_attributed': 0
+}
+
+# A tuple rather than a set so unhashable JSON values (lists, objects) still compare safely
+_INVALID_HANDLES = ("#error_handle", "", None)
+
+_EMAIL_RE = re.compile(r'^[\w\.-]+@[\w\.-]+\.[a-zA-Z]{2,}$')
+_URL_RE = re.compile(r'^https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+')
+
 def is_valid_email(email):
     """Check if email is valid using regex pattern"""
     if email == "invalid-email" or not email:
         return False
-    pattern = r'^[\w\.-]+@[\w\.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    # Non-string values can never match; then a cheap reject before running the regex
+    if not isinstance(email, str) or '@' not in email:
+        return False
+    return bool(_EMAIL_RE.match(email))
 
 def is_valid_date(date_str):
     """Check if date string is valid ISO format"""
     if date_str == "not-a-date" or not date_str:
         return False
+    # Nothing shorter than 'YYYYWww' parses, so skip the raise-and-catch for it
+    if isinstance(date_str, str) and len(date_str) < 7:
+        return False
     try:
         datetime.fromisoformat(date_str.replace('Z', '+00:00'))
         return True
@@ -27,17 +62,20 @@ def is_valid_url(url):
     """Check if URL is valid"""
     if url == "broken_link" or not url:
         return False
-    pattern = r'^https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+'
-    return bool(re.match(pattern, url))
+    # The regex only accepts these schemes, so reject anything else without running it
+    if not url.startswith(('http://', 'https://')):
+        return False
+    return bool(_URL_RE.match(url))
 
 def is_valid_handle(handle):
     """Check if social media handle is valid"""
-    if handle in ["#error_handle", "", None]:
-        return False
-    return True
+    return handle not in _INVALID_HANDLES
 
 def clean_numeric(value):
     """Convert numeric values, handling NaN strings"""
+    # JSON numbers are the common case and need no sentinel checks or try/except
+    if isinstance(value, (int, float)):
+        return float(value)
     if value == "NaN" or value == "no-data" or value is None:
         return 0
     try:
@@ -45,25 +83,54 @@ def clean_numeric(value):
     except (ValueError, TypeError):
         return 0
 
-def get_database_row_count():
+def write_json_records(path, records):
+    """Atomically stream records to a JSON array file and return how many were written
+    
+    Set PRETTY_JSON=1 for indented output.
+    """
+    option = orjson.OPT_INDENT_2 if os.getenv('PRETTY_JSON') else 0
+    separator = b',\n' if option else b','
+    count = 0
+    # Write to a temp file and rename so a killed run never leaves a truncated file
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'[')
+            for record in records:
+                if count:
+                    f.write(separator)
+                f.write(orjson.dumps(record, option=option))
+                count += 1
+            f.write(b']')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Leave only the previous complete file behind, not a partial temp file
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    return count
+
+def get_database_row_count(uploader=None):
     """Get the current number of rows in the database"""
     try:
-        uploader = HerokuPostgreSQLUploader()
+        uploader = uploader or HerokuPostgreSQLUploader()
         with uploader.get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("SELECT COUNT(*) FROM processed_data")
                 count = cursor.fetchone()[0]
-                logging.info(f"Database currently has {count} rows")
+                logging.info("Database currently has %s rows", count)
                 return count
     except Exception as e:
-        logging.error(f"Error checking database row count: {e}")
+        logging.error("Error checking database row count: %s", e)
         return 0
 
 def process_json_file(file_path, user_id):
     """Process a single JSON file and return normalized data"""
     try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
+        with open(file_path, 'rb') as f:
+            data = orjson.loads(f.read())
         
         # Extract user data (root level)
         user_name = data.get('name', '')
@@ -72,6 +139,27 @@ def process_json_file(file_path, user_id):
         tiktok_handle = data.get('tiktok_handle', '')
         joined_at = data.get('joined_at', '')
         
+        # User-level values are the same for every task, so validate them once
+        email_valid = is_valid_email(user_email)
+        if not is_valid_date(joined_at):
+            joined_at = None
+        source_file = os.path.basename(file_path)
+        
+        # Every record shares the user-level fields; task fields start empty
+        base_record = {
+            'user_id': user_id,
+            'name': user_name,
+            'email': user_email,
+            'email_valid': email_valid,
+            'instagram_handle': instagram_handle,
+            'tiktok_handle': tiktok_handle,
+            'joined_at': joined_at,
+            **_EMPTY_TASK_FIELDS,
+            'source_file': source_file,
+            'issues_found': 0,
+            'issues_list': []
+        }
+        
         # Extract advocacy programs data
         advocacy_programs = data.get('advocacy_programs', [])
         
@@ -89,67 +177,45 @@ def process_json_file(file_path, user_id):
             for task_idx, task in enumerate(tasks_completed):
                 # Create a unique task_id if none exists
                 task_id = task.get('task_id') or f"task_{user_id}_{program_idx}_{task_idx}"
+                post_url = task.get('post_url', '')
                 
                 # Normalize the data into a flat structure
-                normalized_record = {
-                    'user_id': user_id,
-                    'name': user_name,
-                    'email': user_email,
-                    'email_valid': is_valid_email(user_email),
-                    'instagram_handle': instagram_handle,
-                    'tiktok_handle': tiktok_handle,
-                    'joined_at': joined_at if is_valid_date(joined_at) else None,
-                    'program_id': program_id,
-                    'brand': brand,
-                    'task_id': str(task_id),
-                    'platform': task.get('platform', ''),
-                    'post_url': task.get('post_url', ''),
-                    'url_valid': is_valid_url(task.get('post_url', '')),
-                    'likes': int(clean_numeric(task.get('likes', 0))),
-                    'comments': int(clean_numeric(task.get('comments', 0))),
-                    'shares': int(clean_numeric(task.get('shares', 0))),
-                    'reach': int(clean_numeric(task.get('reach', 0))),
-                    'total_sales_attributed': total_sales_attributed,
-                    'source_file': os.path.basename(file_path),
-                    'issues_found': 0,
-                    'issues_list': []
-                }
+                normalized_record = base_record.copy()
+                normalized_record['program_id'] = program_id
+                normalized_record['brand'] = brand
+                normalized_record['task_id'] = str(task_id)
+                normalized_record['platform'] = task.get('platform', '')
+                normalized_record['post_url'] = post_url
+                normalized_record['url_valid'] = is_valid_url(post_url)
+                normalized_record['likes'] = int(clean_numeric(task.get('likes', 0)))
+                normalized_record['comments'] = int(clean_numeric(task.get('comments', 0)))
+                normalized_record['shares'] = int(clean_numeric(task.get('shares', 0)))
+                normalized_record['reach'] = int(clean_numeric(task.get('reach', 0)))
+                normalized_record['total_sales_attributed'] = total_sales_attributed
+                normalized_record['issues_list'] = []
                 
                 processed_records.append(normalized_record)
         
         # If no advocacy programs or tasks, create a basic record
         if not processed_records:
-            normalized_record = {
-                'user_id': user_id,
-                'name': user_name,
-                'email': user_email,
-                'email_valid': is_valid_email(user_email),
-                'instagram_handle': instagram_handle,
-                'tiktok_handle': tiktok_handle,
-                'joined_at': joined_at if is_valid_date(joined_at) else None,
-                'program_id': '',
-                'brand': '',
-                'task_id': f"task_{user_id}_0_0",
-                'platform': '',
-                'post_url': '',
-                'url_valid': False,
-                'likes': 0,
-                'comments': 0,
-                'shares': 0,
-                'reach': 0,
-                'total_sales_attributed': 0,
-                'source_file': os.path.basename(file_path),
-                'issues_found': 0,
-                'issues_list': []
-            }
-            processed_records.append(normalized_record)
+            base_record['task_id'] = f"task_{user_id}_0_0"
+            processed_records.append(base_record)
         
         return processed_records
         
     except Exception as e:
-        logging.error(f"Error processing {file_path}: {e}")
+        logging.error("Error processing %s: %s", file_path, e)
         return []
 
+def process_files(file_paths, user_ids):
+    """Yield the normalized records for each file, in input order"""
+    if len(file_paths) < PARALLEL_FILE_THRESHOLD:
+        yield from map(process_json_file, file_paths, user_ids)
+        return
+    
+    with ProcessPoolExecutor() as executor:
+        yield from executor.map(process_json_file, file_paths, user_ids, chunksize=64)
+
 def main():
     # 1. Create tables first if they don't exist
     try:
@@ -158,18 +224,16 @@ def main():
         logging.info("Tables created or already exist")
         database_available = True
     except Exception as e:
-        logging.error(f"Error creating tables: {e}")
+        logging.error("Error creating tables: %s", e)
         database_available = False
         # Create empty processed_data.json and exit
-        with open('processed_data.json', 'w') as f:
-            json.dump([], f)
+        write_json_records(OUTPUT_FILE, [])
         return
     
     # 2. Check current row count in database
-    current_row_count = get_database_row_count()
-    
-    # Directory containing JSON files
-    mixed_dir = os.path.join(os.path.dirname(__file__), "mixed")
+    current_row_count = get_database_row_count(uploader)
+    # Nothing below needs the database, so release the connection before processing
+    uploader.close()
     
     # 3. Determine which files to process
     if current_row_count == 0:
@@ -179,43 +243,56 @@ def main():
         end_file = 10042  # This gives us 10043 files (0 to 10042 inclusive)
     else:
         # Process only the next file: user_{current_row_count}.json
-        logging.info(f"Database has {current_row_count} rows. Processing next file: user_{current_row_count}.json")
+        logging.info("Database has %s rows. Processing next file: user_%s.json", current_row_count, current_row_count)
         start_file = current_row_count
         end_file = current_row_count
     
-    # Process files
-    all_processed_data = []
-    files_processed = 0
+    # For a full run, one directory read beats an existence check per file number;
+    # the usual incremental run checks a single file, which listing would only slow down
+    available_files = None
+    if end_file - start_file + 1 >= PARALLEL_FILE_THRESHOLD:
+        available_files = set(os.listdir(MIXED_DIR)) if os.path.isdir(MIXED_DIR) else set()
     
+    file_paths = []
+    user_ids = []
     for file_number in range(start_file, end_file + 1):
-        file_path = os.path.join(mixed_dir, f"user_{file_number}.json")
+        filename = f"user_{file_number}.json"
         
-        if not os.path.exists(file_path):
-            logging.warning(f"File not found: user_{file_number}.json")
+        if available_files is not None:
+            file_exists = filename in available_files
+        else:
+            file_exists = os.path.exists(os.path.join(MIXED_DIR, filename))
+        if not file_exists:
+            logging.warning("File not found: %s", filename)
             continue
         
+        file_paths.append(os.path.join(MIXED_DIR, filename))
         # User ID should be file_number + 1 (1-indexed)
-        user_id = file_number + 1
-        normalized_records = process_json_file(file_path, user_id)
-        
-        if normalized_records:
-            all_processed_data.extend(normalized_records)
-            files_processed += 1
-            if files_processed % 100 == 0:  # Log progress every 100 files
-                logging.info(f"Processed {files_processed} files so far...")
-        else:
-            logging.error(f"Failed to process {file_path}")
+        user_ids.append(file_number + 1)
+    
+    # Process files
+    files_processed = 0
+    
+    def processed_records():
+        nonlocal files_processed
+        for file_path, normalized_records in zip(file_paths, process_files(file_paths, user_ids)):
+            if normalized_records:
+                files_processed += 1
+                if files_processed % 100 == 0:  # Log progress every 100 files
+                    logging.info("Processed %s files so far...", files_processed)
+                yield from normalized_records
+            else:
+                logging.error("Failed to process %s", file_path)
     
-    # Save all processed data to JSON file (required by the workflow)
-    with open('processed_data.json', 'w') as f:
-        json.dump(all_processed_data, f, indent=2)
+    # Stream processed data to the JSON file (required by the workflow) as each file completes
+    records_created = write_json_records(OUTPUT_FILE, processed_records())
     
-    logging.info(f"Successfully processed {files_processed} files. Created {len(all_processed_data)} records. Data saved to processed_data.json")
+    logging.info("Successfully processed %s files. Created %s records. Data saved to %s", files_processed, records_created, OUTPUT_FILE)
     
     if files_processed == 0:
         logging.warning("No files were processed")
     else:
-        logging.info(f"Ready to upload {len(all_processed_data)} records to database")
+        logging.info("Ready to upload %s records to database", records_created)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,10 +1,10 @@
+import io
 import os
-import json
 import logging
-import glob
 from datetime import datetime
+import orjson
 import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -19,23 +19,67 @@ logging.basicConfig(
     ]
 )
 
+# Columns loaded by upload_processed_data, in COPY order
+PROCESSED_DATA_COLUMNS = (
+    'user_id', 'name', 'email', 'email_valid', 'instagram_handle', 'tiktok_handle',
+    'joined_at', 'program_id', 'brand', 'task_id', 'platform', 'post_url', 'url_valid',
+    'likes', 'comments', 'shares', 'reach', 'total_sales_attributed', 'source_file',
+    'issues_found', 'issues_list'
+)
+
+def to_copy_text(value):
+    """Format a value as a field for COPY ... FROM STDIN in text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, list):
+        value = ','.join(value)
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
 class HerokuPostgreSQLUploader:
-    def __init__(self):
+    def __init__(self, connection=None):
         self.database_url = os.getenv('HEROKU_DATABASE_URL') or os.getenv('DATABASE_URL')
-        if not self.database_url:
+        if not self.database_url and connection is None:
             raise ValueError("Database URL not found in environment variables")
         
         self.logger = logging.getLogger(__name__)
+        # Reused across calls; `with conn:` only scopes a transaction, it does not close
+        self._conn = connection
+        # A connection passed in belongs to the caller, so it is never closed or replaced here
+        self._owns_conn = connection is None
     
     def get_connection(self):
-        """Get database connection"""
+        """Get database connection, reusing the open one if there is one"""
+        if self._conn is not None and not self._conn.closed:
+            return self._conn
+        if not self._owns_conn:
+            raise psycopg2.InterfaceError("Connection passed to the uploader is closed")
+        
         try:
-            conn = psycopg2.connect(self.database_url)
-            return conn
+            # Keepalives stop Heroku from dropping the reused connection while it sits idle
+            self._conn = psycopg2.connect(self.database_url, keepalives=1, keepalives_idle=30)
+            return self._conn
         except Exception as e:
-            self.logger.error(f"Error connecting to database: {e}")
+            self.logger.error("Error connecting to database: %s", e)
             raise
     
+    def close(self):
+        """Close the cached database connection if the uploader opened it"""
+        if not self._owns_conn:
+            return
+        if self._conn is not None and not self._conn.closed:
+            self._conn.close()
+        self._conn = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
     def create_tables(self):
         """Create necessary tables if they don't exist"""
         try:
@@ -84,7 +128,7 @@ class HerokuPostgreSQLUploader:
                     conn.commit()
                     self.logger.info("Tables created successfully")
         except Exception as e:
-            self.logger.error(f"Error creating tables: {e}")
+            self.logger.error("Error creating tables: %s", e)
             raise
     
     def upload_processed_data(self, data_records):
@@ -94,39 +138,27 @@ class HerokuPostgreSQLUploader:
             return 0
         
         try:
+            # Stream every row through a single COPY instead of one INSERT per record
+            buffer = io.StringIO()
+            for record in data_records:
+                buffer.write('\t'.join(to_copy_text(record.get(column)) for column in PROCESSED_DATA_COLUMNS))
+                buffer.write('\n')
+            buffer.seek(0)
+            
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
-                    # Prepare insert query
-                    insert_query = """
-                        INSERT INTO processed_data (
-                            user_id, name, email, email_valid, instagram_handle, tiktok_handle,
-                            joined_at, program_id, brand, task_id, platform, post_url, url_valid,
-                            likes, comments, shares, reach, total_sales_attributed, source_file,
-                            issues_found, issues_list
-                        ) VALUES (
-                            %(user_id)s, %(name)s, %(email)s, %(email_valid)s, %(instagram_handle)s,
-                            %(tiktok_handle)s, %(joined_at)s, %(program_id)s, %(brand)s, %(task_id)s,
-                            %(platform)s, %(post_url)s, %(url_valid)s, %(likes)s, %(comments)s,
-                            %(shares)s, %(reach)s, %(total_sales_attributed)s, %(source_file)s,
-                            %(issues_found)s, %(issues_list)s
-                        )
-                    """
-                    
-                    # Convert issues_list to string if it's a list
-                    for record in data_records:
-                        if isinstance(record.get('issues_list'), list):
-                            record['issues_list'] = ','.join(record['issues_list'])
-                    
-                    # Execute batch insert
-                    cursor.executemany(insert_query, data_records)
+                    cursor.copy_expert(
+                        f"COPY processed_data ({', '.join(PROCESSED_DATA_COLUMNS)}) FROM STDIN",
+                        buffer
+                    )
                     conn.commit()
                     
                     uploaded_count = len(data_records)
-                    self.logger.info(f"Successfully uploaded {uploaded_count} records")
+                    self.logger.info("Successfully uploaded %s records", uploaded_count)
                     return uploaded_count
                     
         except Exception as e:
-            self.logger.error(f"Error uploading data: {e}")
+            self.logger.error("Error uploading data: %s", e)
             raise
     
     def log_processing_stats(self, run_id, commit_sha, files_processed, records_created, processing_time, status, error_message=None):
@@ -144,7 +176,7 @@ class HerokuPostgreSQLUploader:
                     conn.commit()
                     self.logger.info("Processing stats logged successfully")
         except Exception as e:
-            self.logger.error(f"Error logging processing stats: {e}")
+            self.logger.error("Error logging processing stats: %s", e)
             raise
     
     def get_last_uploaded_user_number(self):
@@ -156,7 +188,7 @@ class HerokuPostgreSQLUploader:
                     result = cursor.fetchone()[0]
                     return result if result is not None else 0
         except Exception as e:
-            self.logger.error(f"Error getting last uploaded user number: {e}")
+            self.logger.error("Error getting last uploaded user number: %s", e)
             return 0
     
     def table_exists(self, table_name):
@@ -172,12 +204,12 @@ class HerokuPostgreSQLUploader:
                     """, (table_name,))
                     return cursor.fetchone()[0]
         except Exception as e:
-            self.logger.error(f"Error checking if table exists: {e}")
+            self.logger.error("Error checking if table exists: %s", e)
             return False
 
 class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
-    def __init__(self, mixed_dir="mixed"):
-        super().__init__()
+    def __init__(self, mixed_dir="mixed", connection=None):
+        super().__init__(connection=connection)
         self.mixed_dir = mixed_dir
         
     def check_tables_exist(self):
@@ -193,10 +225,10 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
                         );
                     """)
                     tables_exist = cur.fetchone()[0]
-                    self.logger.info(f"Tables exist: {tables_exist}")
+                    self.logger.info("Tables exist: %s", tables_exist)
                     return tables_exist
         except Exception as e:
-            self.logger.error(f"Error checking if tables exist: {e}")
+            self.logger.error("Error checking if tables exist: %s", e)
             return False
     
     def get_last_uploaded_user_number(self):
@@ -207,10 +239,10 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
                     cur.execute("SELECT MAX(user_id) FROM processed_data")
                     result = cur.fetchone()[0]
                     last_number = result if result is not None else -1
-                    self.logger.info(f"Last uploaded user number: {last_number}")
+                    self.logger.info("Last uploaded user number: %s", last_number)
                     return last_number
         except Exception as e:
-            self.logger.error(f"Error getting last uploaded user number: {e}")
+            self.logger.error("Error getting last uploaded user number: %s", e)
             return -1
     
     def get_last_processed_file_number(self):
@@ -221,37 +253,44 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
                     cur.execute("SELECT MAX(CAST(REPLACE(REPLACE(source_file, 'user_', ''), '.json', '') AS INTEGER)) FROM processed_data WHERE source_file LIKE 'user_%.json'")
                     result = cur.fetchone()[0]
                     last_number = result if result is not None else -1
-                    self.logger.info(f"Last processed file number: {last_number}")
+                    self.logger.info("Last processed file number: %s", last_number)
                     return last_number
         except Exception as e:
-            self.logger.error(f"Error getting last processed file number: {e}")
+            self.logger.error("Error getting last processed file number: %s", e)
             return -1
     
     def get_available_user_files(self):
         """Get list of available user files and their numbers"""
-        pattern = os.path.join(self.mixed_dir, "user_*.json")
-        files = glob.glob(pattern)
-        
         file_numbers = []
-        for file_path in files:
-            filename = os.path.basename(file_path)
-            try:
-                # Extract number from filename like "user_123.json"
-                number = int(filename.replace("user_", "").replace(".json", ""))
-                file_numbers.append((number, file_path))
-            except ValueError:
-                self.logger.warning(f"Skipping file with invalid format: {filename}")
+        if not os.path.isdir(self.mixed_dir):
+            self.logger.info("Found 0 user files")
+            return file_numbers
+        
+        # Single directory pass; DirEntry already carries the name and path
+        with os.scandir(self.mixed_dir) as entries:
+            for entry in entries:
+                filename = entry.name
+                if not (filename.startswith("user_") and filename.endswith(".json")):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    # Extract number from filename like "user_123.json"
+                    number = int(filename[len("user_"):-len(".json")])
+                    file_numbers.append((number, entry.path))
+                except ValueError:
+                    self.logger.warning("Skipping file with invalid format: %s", filename)
         
         # Sort by number
         file_numbers.sort(key=lambda x: x[0])
-        self.logger.info(f"Found {len(file_numbers)} user files")
+        self.logger.info("Found %s user files", len(file_numbers))
         return file_numbers
     
     def process_user_file(self, file_path, user_number):
         """Process a single user file and return records"""
         try:
-            with open(file_path, 'r') as f:
-                user_data = json.load(f)
+            with open(file_path, 'rb') as f:
+                user_data = orjson.loads(f.read())
             
             processed_records = []
             
@@ -295,7 +334,7 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
             return processed_records
             
         except Exception as e:
-            self.logger.error(f"Error processing file {file_path}: {e}")
+            self.logger.error("Error processing file %s: %s", file_path, e)
             return []
     
     def batch_upload_records(self, records, batch_size=1000):
@@ -305,6 +344,8 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
             return 0
         
         total_uploaded = 0
+        # One timestamp for the whole upload rather than one per record
+        created_at = datetime.now()
         
         try:
             with self.get_connection() as conn:
@@ -315,7 +356,7 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
                         (user_id, name, email, instagram_handle, tiktok_handle, joined_at,
                          program_id, brand, task_id, platform, post_url, likes, comments, 
                          shares, reach, total_sales_attributed, source_file, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        VALUES %s
                     """
                     
                     # Process in batches
@@ -351,22 +392,22 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
                                 record.get('reach', 0),
                                 record.get('total_sales_attributed', 0),
                                 record.get('source_file'),
-                                datetime.now()
+                                created_at
                             ))
                         
-                        # Execute batch
-                        execute_batch(cur, insert_sql, batch_data, page_size=batch_size)
+                        # One multi-row INSERT per batch rather than one statement per row
+                        execute_values(cur, insert_sql, batch_data, page_size=batch_size)
                         batch_uploaded = cur.rowcount
                         total_uploaded += batch_uploaded
                         
-                        self.logger.info(f"Uploaded batch {i//batch_size + 1}: {batch_uploaded} records")
+                        self.logger.info("Uploaded batch %s: %s records", i//batch_size + 1, batch_uploaded)
                     
                     conn.commit()
-                    self.logger.info(f"Total records uploaded: {total_uploaded}")
+                    self.logger.info("Total records uploaded: %s", total_uploaded)
                     return total_uploaded
                     
         except Exception as e:
-            self.logger.error(f"Error during batch upload: {e}")
+            self.logger.error("Error during batch upload: %s", e)
             return 0
     
     def run_upload_process(self, start_file=None, end_file=None):
@@ -385,7 +426,7 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
         available_files = self.get_available_user_files()
         
         if not available_files:
-            self.logger.warning(f"No user files found in {self.mixed_dir} directory")
+            self.logger.warning("No user files found in %s directory", self.mixed_dir)
             return
         
         # Step 3: Determine which files to process
@@ -403,16 +444,16 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
                 files_to_process = available_files
             else:
                 # Upload only files after the last uploaded
-                self.logger.info(f"Last uploaded file: user_{last_uploaded}.json")
+                self.logger.info("Last uploaded file: user_%s.json", last_uploaded)
                 files_to_process = [(num, path) for num, path in available_files if num > last_uploaded]
-                self.logger.info(f"Found {len(files_to_process)} new files to process")
+                self.logger.info("Found %s new files to process", len(files_to_process))
         
         # Apply custom range if specified
         if start_file is not None or end_file is not None:
             start = start_file if start_file is not None else 0
             end = end_file if end_file is not None else 9999
             files_to_process = [(num, path) for num, path in files_to_process if start <= num <= end]
-            self.logger.info(f"Custom range applied: {len(files_to_process)} files to process")
+            self.logger.info("Custom range applied: %s files to process", len(files_to_process))
         
         if not files_to_process:
             self.logger.info("No new files to process")
@@ -423,7 +464,7 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
         processed_count = 0
         
         for user_number, file_path in files_to_process:
-            self.logger.info(f"Processing file: {os.path.basename(file_path)}")
+            self.logger.debug("Processing file: %s", file_path)
             
             records = self.process_user_file(file_path, user_number)
             all_records.extend(records)
@@ -432,15 +473,15 @@ class EnhancedHerokuUploader(HerokuPostgreSQLUploader):
             # Upload in batches of files to avoid memory issues
             if len(all_records) >= 5000:  # Upload every 5000 records
                 uploaded = self.batch_upload_records(all_records)
-                self.logger.info(f"Uploaded {uploaded} records from {processed_count} files")
+                self.logger.info("Uploaded %s records from %s files", uploaded, processed_count)
                 all_records = []  # Clear memory
         
         # Upload remaining records
         if all_records:
             uploaded = self.batch_upload_records(all_records)
-            self.logger.info(f"Uploaded final batch: {uploaded} records")
+            self.logger.info("Uploaded final batch: %s records", uploaded)
         
-        self.logger.info(f"Upload process completed. Processed {processed_count} files.")
+        self.logger.info("Upload process completed. Processed %s files.", processed_count)
 
 def main():
     """Main function to run the enhanced uploader"""
@@ -456,8 +497,10 @@ def main():
         uploader.run_upload_process()
         
     except Exception as e:
-        logger.error(f"Upload process failed: {e}")
+        logger.error("Upload process failed: %s", e)
         exit(1)
+    finally:
+        uploader.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file